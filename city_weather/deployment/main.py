@@ -1,16 +1,19 @@
 import asyncio
+import collections
 import importlib
-import json
 import logging
 import os
 import sys
 from typing import Optional
 
 # Configure logging first, before loading .env
+# force=True replaces any root handlers installed earlier (e.g. by imported
+# libraries); uvicorn's log config only touches its own uvicorn.* loggers.
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler(sys.stdout)]
+    handlers=[logging.StreamHandler(sys.stdout)],
+    force=True,
 )
 logger = logging.getLogger(__name__)
 
@@ -25,36 +28,51 @@ env_loaded = False
 
 if env_path.exists():
     load_dotenv(env_path, override=True)
-    logger.info(f"✓ Loaded .env from: {env_path}")
+    logger.info("✓ Loaded .env from: %s", env_path)
     env_loaded = True
 else:
     # Fallback to find_dotenv() behavior
     dotenv_path = find_dotenv()
     if dotenv_path:
         load_dotenv(dotenv_path, override=True)
-        logger.info(f"✓ Loaded .env from: {dotenv_path}")
+        logger.info("✓ Loaded .env from: %s", dotenv_path)
         env_loaded = True
     else:
         logger.warning("⚠ No .env file found!")
-        logger.warning(f"  Expected location: {env_path}")
+        logger.warning("  Expected location: %s", env_path)
         logger.warning("  Using environment variables only.")
         logger.warning("  To create .env file: cp .env.example .env")
 
+import msgspec
+import orjson
 from fastapi import FastAPI
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict, field_validator
 
 from google.adk.sessions.in_memory_session_service import InMemorySessionService
 from google.adk.artifacts.in_memory_artifact_service import InMemoryArtifactService
 from google.adk.runners import Runner
 from google.genai.types import Content, Part
-from multi_tool_agent.agent import root_agent  # ← your custom agent
+from multi_tool_agent.agent import (  # ← your custom agent
+    root_agent,
+    create_http_client,
+    set_http_client,
+    close_http_client,
+    warm_http_client,
+)
 from utility.helper import (
-    save_conversation,
+    Message,
+    enqueue_conversation,
+    load_conversation,
+    start_conversation_writer,
+    stop_conversation_writer,
     create_runner,
+    get_runner,
     build_content_with_history,
     process_event_parts,
 )
 from utility.tracing import setup_tracing, get_tracer
+from utility.admission import Admission
 
 
 DB_COLLECTION = os.getenv("DB_COLLECTION", "Weather-Chat")
@@ -66,12 +84,56 @@ artifact_service = InMemoryArtifactService()
 MAX_HISTORY_MESSAGES = int(os.getenv("MAX_HISTORY_MESSAGES", "20"))
 MAX_HISTORY_CHARS = int(os.getenv("MAX_HISTORY_CHARS", "8000"))
 
+# Cap on concurrent agent runs across /chat and /chat/stream (configurable via env)
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "64"))
+admission = Admission(MAX_CONCURRENCY)
+
+# Upper bound on a single agent run, in seconds (configurable via env)
+CHAT_TIMEOUT_S = float(os.getenv("CHAT_TIMEOUT_S", "60"))
+
 class ChatRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     user_id: str
-    session_id: Optional[str] = None  # "None" indicates new conversation
+    session_id: Optional[str] = None  # None indicates new conversation
     query: str
 
-async def run_query(user_id: str, session_id: Optional[str], query: str):
+    @field_validator("session_id", mode="before")
+    @classmethod
+    def _normalize_session_id(cls, value):
+        """Treat "null" and "" from clients as a new conversation."""
+        if value in ("null", ""):
+            return None
+        return value
+
+def _session_attributes(session_id: str) -> dict:
+    """
+    Span attributes used by LangSmith to group traces into threads.
+    LangSmith recognizes session_id, thread_id, conversation_id and their
+    langsmith.* namespaced forms.
+    """
+    return {
+        "session_id": session_id,
+        "thread_id": session_id,
+        "conversation_id": session_id,
+        "langsmith.session_id": session_id,
+        "langsmith.thread_id": session_id,
+    }
+
+def final_response_text(processed: Optional[Message]) -> Optional[str]:
+    """Text reply for a final processed event, falling back to its serialized parts."""
+    if processed is None:
+        return None
+    return processed.text or msgspec.json.encode(processed.parts, enc_hook=str).decode()
+
+async def stream_query(user_id: str, session_id: Optional[str], query: str):
+    """
+    Run the agent and yield (session_id, processed_event, is_final) tuples.
+    The first tuple carries only the session_id (processed_event is None) so
+    callers learn it before the agent produces output; is_final is True for
+    the agent's final response (see final_response_text). The turn is queued
+    for persistence once the agent run completes.
+    """
     tracer = get_tracer(__name__)
     span = None
     
@@ -80,56 +142,65 @@ async def run_query(user_id: str, session_id: Optional[str], query: str):
     actual_session_id = str(session_id) if session_id else "new"
     
     if tracer:
-        span = tracer.start_span("run_query")
-        
-        # Set standard attributes
-        span.set_attribute("user_id", user_id)
-        span.set_attribute("session_id", actual_session_id)
-        span.set_attribute("query", query)
-        
-        # Set LangSmith-recognized metadata attributes for thread grouping
-        # LangSmith recognizes: session_id, thread_id, or conversation_id in span attributes
-        span.set_attribute("thread_id", actual_session_id)
-        span.set_attribute("conversation_id", actual_session_id)
-        # LangSmith also recognizes namespaced attributes
-        span.set_attribute("langsmith.session_id", actual_session_id)
-        span.set_attribute("langsmith.thread_id", actual_session_id)
+        # Detached (not start_as_current_span) so it doesn't stay current in
+        # the consumer between yields; all attributes are set in a single call.
+        span = tracer.start_span(
+            "run_query",
+            attributes={"user_id": user_id, "query": query, **_session_attributes(actual_session_id)},
+        )
     
     try:
-        session, runner = await create_runner(user_id, session_id)
+        if session_id:
+            # Independent I/O: resolve the session while fetching its history
+            (session, runner), prior_messages = await asyncio.gather(
+                create_runner(user_id, session_id),
+                load_conversation(user_id=user_id, session_id=session_id, bot_collection=DB_COLLECTION),
+            )
+        else:
+            # New conversation: nothing stored yet
+            session, runner = await create_runner(user_id, session_id)
+            prior_messages = []
         
         # Update session_id attributes with the actual session.id from ADK
         actual_session_id = str(session.id)
         if span:
-            span.set_attribute("session_id", actual_session_id)
-            span.set_attribute("thread_id", actual_session_id)
-            span.set_attribute("conversation_id", actual_session_id)
-            span.set_attribute("langsmith.session_id", actual_session_id)
-            span.set_attribute("langsmith.thread_id", actual_session_id)
+            span.set_attributes(_session_attributes(actual_session_id))
         
-        content = await build_content_with_history(user_id, session, query)
+        yield session.id, None, None
 
-        final_text = None
-        events = []
+        content = await build_content_with_history(user_id, session, query, prior_messages=prior_messages)
+
+        final_processed = None
+        events = collections.deque()
         async for event in runner.run_async(user_id=session.user_id, session_id=session.id, new_message=content):
             processed = process_event_parts(event)
             if processed:
                 events.append(processed)
-                if getattr(event, "is_final_response", lambda: False)():
-                    final_text = processed.get("text") or json.dumps(processed.get("parts", []), ensure_ascii=False)
+                is_final = getattr(event, "is_final_response", None)
+                is_final = is_final is not None and is_final()
+                if is_final:
+                    final_processed = processed
+                yield session.id, processed, is_final
 
         try:
-            messages = [{"sender": "user", "text": query}] + events
-            # save_conversation signature: (user_id, session_id, messages, bot_collection=None)
-            await save_conversation(user_id, session.id, messages)
+            messages = [Message(sender="user", text=query)]
+            messages.extend(events)
+            # Queued for the background batch writer; the reply doesn't depend on it
+            enqueue_conversation(user_id, session.id, messages, new_conversation=not session_id)
         except Exception:
-            logging.exception("Failed to save conversation to Firestore")
+            logging.exception("Failed to queue conversation for Firestore")
 
         if span:
-            span.set_attribute("response_length", len(final_text) if final_text else 0)
-            span.set_attribute("events_count", len(events))
-        
-        return final_text, session.id
+            final_text = final_response_text(final_processed)
+            span.set_attributes({
+                "response_length": len(final_text) if final_text else 0,
+                "events_count": len(events),
+            })
+    except asyncio.CancelledError:
+        if span:
+            from opentelemetry.trace import Status, StatusCode
+            span.set_status(Status(StatusCode.ERROR, "Agent run cancelled (timeout or client disconnect)"))
+        raise
     except Exception as e:
         if span:
             from opentelemetry.trace import Status, StatusCode
@@ -140,7 +211,55 @@ async def run_query(user_id: str, session_id: Optional[str], query: str):
         if span:
             span.end()
 
-app = FastAPI()
+class RunTimeoutError(asyncio.TimeoutError):
+    """The agent run exceeded CHAT_TIMEOUT_S; session_id is the one already resolved."""
+    def __init__(self, session_id: Optional[str]):
+        super().__init__(f"Agent run timed out after {CHAT_TIMEOUT_S}s")
+        self.session_id = session_id
+
+async def _iter_with_deadline(agen, timeout: float):
+    """
+    Re-yield items from agen, raising asyncio.TimeoutError once timeout seconds
+    have elapsed in total. The pending step is cancelled inside agen, so its
+    cleanup (span end, etc.) still runs.
+    Each step is awaited directly in the consumer's task (not wrapped in a new
+    Task as wait_for does before 3.12), so context variables set by agen and
+    by ADK's run_async, like the current span, persist across steps. The
+    timeout scope covers only the step, never a yield.
+    """
+    deadline = asyncio.get_running_loop().time() + timeout
+    try:
+        while True:
+            try:
+                async with asyncio.timeout_at(deadline):
+                    item = await agen.__anext__()
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        await agen.aclose()
+
+async def run_query(user_id: str, session_id: Optional[str], query: str):
+    """
+    Run the agent to completion and return (final_text, session_id).
+    Raises RunTimeoutError (an asyncio.TimeoutError) if the run exceeds CHAT_TIMEOUT_S.
+    """
+    final_processed = None
+    actual_session_id = session_id
+    events = _iter_with_deadline(stream_query(user_id, session_id, query), CHAT_TIMEOUT_S)
+    try:
+        async for actual_session_id, processed, is_final in events:
+            if is_final:
+                final_processed = processed
+    except asyncio.TimeoutError:
+        raise RunTimeoutError(actual_session_id) from None
+    return final_response_text(final_processed), actual_session_id
+
+def _sse(event: str, data) -> bytes:
+    """Encode one Server-Sent Events frame."""
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data, default=str) + b"\n\n"
+
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # Initialize tracing at startup
 @app.on_event("startup")
@@ -149,6 +268,12 @@ async def startup_event():
     logger.info("=" * 60)
     logger.info("Starting application initialization...")
     logger.info("=" * 60)
+
+    # Eager tasks run synchronously until their first real suspension,
+    # skipping a scheduler hop for the many short-lived agent tasks (3.12+)
+    if sys.version_info >= (3, 12):
+        asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
+        logger.info("✓ Eager task factory enabled")
     
     # Log environment status
     if env_loaded:
@@ -167,7 +292,7 @@ async def startup_event():
         #     api_key=os.getenv("LANGSMITH_API_KEY"),
         # )
     except Exception as e:
-        logger.error(f"Failed to initialize tracing: {e}", exc_info=True)
+        logger.error("Failed to initialize tracing: %s", e, exc_info=True)
     
     # Instrument FastAPI with OpenTelemetry
     # Note: HTTP spans will go to Cloud Trace
@@ -184,12 +309,37 @@ async def startup_event():
     except ImportError:
         logger.warning("⚠ FastAPI instrumentation not available")
     except Exception as e:
-        logger.warning(f"⚠ Failed to instrument FastAPI: {e}")
+        logger.warning("⚠ Failed to instrument FastAPI: %s", e)
+
+    # Shared pooled HTTP client for the agent's Open-Meteo tool calls
+    app.state.http = create_http_client()
+    set_http_client(app.state.http)
+    await warm_http_client(app.state.http)
+    logger.info("✓ Async HTTP client initialized and warmed for agent tools")
+
+    # Build the ADK Runner once; create_runner() reuses it for every request
+    try:
+        app.state.runner = get_runner()
+        logger.info("✓ ADK Runner initialized")
+    except Exception as e:
+        logger.error("Failed to initialize ADK Runner: %s", e, exc_info=True)
+
+    # Background batch writer for conversation persistence
+    start_conversation_writer()
+    logger.info("✓ Conversation writer started")
     
     logger.info("=" * 60)
     logger.info("Application startup complete")
     logger.info("=" * 60)
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Release shared resources on application shutdown."""
+    await stop_conversation_writer()
+    logger.info("Conversation writer drained and stopped")
+    await close_http_client()
+    logger.info("Async HTTP client closed")
+
 @app.post("/chat")
 async def chat_endpoint(request: ChatRequest):
     """
@@ -201,9 +351,60 @@ async def chat_endpoint(request: ChatRequest):
         "query":     "Hello?"
     }
     """
-    final_response, session_id = await run_query(
-        user_id=request.user_id,
-        session_id=request.session_id if request.session_id not in (None, "null") else None,
-        query=request.query,
-    )
+    session_id = request.session_id
+    async with admission.slot():
+        try:
+            final_response, session_id = await run_query(
+                user_id=request.user_id,
+                session_id=session_id,
+                query=request.query,
+            )
+        except RunTimeoutError as e:
+            logger.warning("Agent run timed out after %ss (user_id=%s)", CHAT_TIMEOUT_S, request.user_id)
+            return ORJSONResponse(
+                status_code=504,
+                content={"error": f"Agent run timed out after {CHAT_TIMEOUT_S}s", "session_id": e.session_id},
+            )
     return {"response": final_response, "session_id": session_id}
+
+@app.post("/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest):
+    """
+    POST /chat/stream
+    -----------------
+    Same body as /chat. Responds with Server-Sent Events as the agent runs:
+      event: session  -> {"session_id": ...}
+      event: message  -> {"sender": ..., "text": ..., "parts": [...]}  (one per agent event)
+      event: done     -> {"response": ..., "session_id": ...}
+      event: error    -> {"error": ..., "session_id": ...}  (including CHAT_TIMEOUT_S expiry)
+    """
+    session_id = request.session_id
+
+    async def sse_stream():
+        final_processed = None
+        actual_session_id = session_id
+        try:
+            # The slot is held for the whole stream, not just until headers are sent
+            async with admission.slot():
+                events = _iter_with_deadline(
+                    stream_query(user_id=request.user_id, session_id=session_id, query=request.query),
+                    CHAT_TIMEOUT_S,
+                )
+                async for actual_session_id, processed, is_final in events:
+                    if processed is None:
+                        yield _sse("session", {"session_id": actual_session_id})
+                        continue
+                    if is_final:
+                        final_processed = processed
+                    yield _sse("message", msgspec.to_builtins(processed, enc_hook=str))
+        except asyncio.TimeoutError:
+            logger.warning("Streaming agent run timed out after %ss (user_id=%s)", CHAT_TIMEOUT_S, request.user_id)
+            yield _sse("error", {"error": f"Agent run timed out after {CHAT_TIMEOUT_S}s", "session_id": actual_session_id})
+            return
+        except Exception as e:
+            logger.exception("Streaming agent run failed")
+            yield _sse("error", {"error": str(e), "session_id": actual_session_id})
+            return
+        yield _sse("done", {"response": final_response_text(final_processed), "session_id": actual_session_id})
+
+    return StreamingResponse(sse_stream(), media_type="text/event-stream")
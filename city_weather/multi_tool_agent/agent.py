@@ -1,121 +1,230 @@
 # multi_tool_agent/agent.py
+import asyncio
+import csv
 import datetime
+import functools
 from zoneinfo import ZoneInfo
 from google.adk.agents import Agent
 from typing import Dict, Any, Optional
 import os
 import logging
 
-import requests
-from utility.tracing import get_tracer
+import httpx
+import orjson
+from async_lru import alru_cache
+from utility.tracing import get_tracer, traced_span
 
 logger = logging.getLogger(__name__)
 
 GEOCODING_URL = os.getenv("GEOCODING_URL", "https://geocoding-api.open-meteo.com/v1/search")
 WEATHER_URL = os.getenv("WEATHER_URL", "https://api.open-meteo.com/v1/forecast")
 
-def _geocode_city(city: str) -> Optional[Dict[str, Any]]:
+# Cache TTLs (seconds): city coordinates are effectively static, current weather is not
+GEOCODE_CACHE_TTL = int(os.getenv("GEOCODE_CACHE_TTL", "86400"))
+WEATHER_CACHE_TTL = int(os.getenv("WEATHER_CACHE_TTL", "300"))
+
+# Optional static city table: CSV with header name,latitude,longitude,timezone,country
+# (e.g. an extract of GeoNames cities1000, most populous first). Hits skip the
+# geocoding API entirely; misses fall back to it.
+CITIES_TABLE_PATH = os.getenv("CITIES_TABLE_PATH")
+
+
+def _load_city_table(path: Optional[str]) -> Dict[str, Dict[str, Any]]:
+    """Load the city table into {lowercased name: geocoding-style result}.
+    The first row wins for duplicate names. Returns {} if path is unset or unreadable.
+    """
+    if not path:
+        return {}
+    table: Dict[str, Dict[str, Any]] = {}
+    try:
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                key = row["name"].strip().lower()
+                if key in table:
+                    continue
+                table[key] = {
+                    "name": row["name"],
+                    "latitude": float(row["latitude"]),
+                    "longitude": float(row["longitude"]),
+                    "timezone": row.get("timezone") or None,
+                    "country": row.get("country") or None,
+                }
+    except (OSError, KeyError, ValueError) as e:
+        logger.warning("⚠ Failed to load city table from %s: %s", path, e)
+        return {}
+    logger.info("Loaded %s cities from %s", len(table), path)
+    return table
+
+
+_city_table = _load_city_table(CITIES_TABLE_PATH)
+
+# Shared async HTTP client for Open-Meteo calls.
+# Created/closed by the FastAPI startup/shutdown hooks in deployment/main.py.
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def create_http_client() -> httpx.AsyncClient:
+    """Build the pooled async HTTP client used for Open-Meteo requests."""
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(5.0, connect=2.0),
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    )
+
+
+async def warm_http_client(client: httpx.AsyncClient) -> None:
+    """Open pooled connections to the Open-Meteo hosts ahead of the first request.
+    Hosts are warmed concurrently, so startup waits at most one timeout.
+    Failures are logged and ignored; the pool simply fills lazily instead.
+    """
+    urls = (GEOCODING_URL, WEATHER_URL)
+    results = await asyncio.gather(*(client.head(url) for url in urls), return_exceptions=True)
+    for url, result in zip(urls, results):
+        if isinstance(result, httpx.HTTPError):
+            logger.warning("⚠ Failed to warm HTTP connection to %s: %s", url, result)
+        elif isinstance(result, BaseException):
+            raise result
+
+
+def set_http_client(client: Optional[httpx.AsyncClient]) -> None:
+    """Install (or clear, with None) the shared HTTP client."""
+    global _http_client
+    _http_client = client
+
+
+async def close_http_client() -> None:
+    """Close and clear the shared HTTP client, if any."""
+    global _http_client
+    client, _http_client = _http_client, None
+    if client is not None:
+        await client.aclose()
+
+
+def _get_http_client() -> httpx.AsyncClient:
+    """Return the shared client, creating one lazily (e.g. `adk web` without main.py)."""
+    global _http_client
+    if _http_client is None:
+        _http_client = create_http_client()
+    return _http_client
+
+
+@alru_cache(maxsize=4096, ttl=GEOCODE_CACHE_TTL)
+async def _fetch_geocode(name: str) -> Optional[Dict[str, Any]]:
+    """
+    Cached Open-Meteo geocoding lookup keyed by normalized city name.
+    Concurrent calls for the same name share one in-flight request.
+    HTTP and JSON decode errors propagate, so failed lookups are never cached.
+    """
+    resp = await _get_http_client().get(
+        GEOCODING_URL,
+        params={
+            "name": name,
+            "count": 1,
+            "language": "en",
+            "format": "json",
+        },
+    )
+    resp.raise_for_status()
+    data = orjson.loads(resp.content)
+
+    results = data.get("results") or []
+    return results[0] if results else None
+
+
+@alru_cache(maxsize=4096, ttl=WEATHER_CACHE_TTL)
+async def _fetch_weather(lat: float, lon: float) -> Optional[Dict[str, Any]]:
+    """
+    Cached Open-Meteo current-weather lookup keyed by coordinates.
+    Same coalescing and error semantics as _fetch_geocode.
+    """
+    resp = await _get_http_client().get(
+        WEATHER_URL,
+        params={
+            "latitude": lat,
+            "longitude": lon,
+            "current_weather": "true",
+            "timezone": "auto",  # Open-Meteo resolves local timezone
+        },
+    )
+    resp.raise_for_status()
+    data = orjson.loads(resp.content)
+
+    current = data.get("current_weather")
+    if not current:
+        return None
+
+    return {
+        "temperature_c": current.get("temperature"),
+        "windspeed_kmh": current.get("windspeed"),
+        "weather_code": current.get("weathercode"),
+        "timezone": data.get("timezone"),
+        "raw": current,
+    }
+
+
+async def _geocode_city(city: str) -> Optional[Dict[str, Any]]:
     """
     Resolve city name to latitude, longitude, and timezone
-    using Open-Meteo Geocoding API.
+    from the static city table, falling back to the Open-Meteo Geocoding API.
     """
-    tracer = get_tracer(__name__)
-    span = None
-    if tracer:
-        span = tracer.start_span("geocode_city")
-        span.set_attribute("city", city)
-    
-    try:
-        resp = requests.get(
-            GEOCODING_URL,
-            params={
-                "name": city,
-                "count": 1,
-                "language": "en",
-                "format": "json",
-            },
-            timeout=5,
-        )
-        resp.raise_for_status()
-        data = resp.json()
-        
-        results = data.get("results") or []
-        if not results:
+    with traced_span(get_tracer(__name__), "geocode_city", {"city": city}) as span:
+        try:
+            name = city.strip().lower()
+            result = _city_table.get(name) or await _fetch_geocode(name)
+            if not result:
+                if span:
+                    span.set_attribute("found", False)
+                return None
+
             if span:
-                span.set_attribute("found", False)
-            return None
+                span.set_attributes({
+                    "found": True,
+                    "latitude": result.get("latitude", 0),
+                    "longitude": result.get("longitude", 0),
+                })
 
-        result = results[0]
-        if span:
-            span.set_attribute("found", True)
-            span.set_attribute("latitude", result.get("latitude", 0))
-            span.set_attribute("longitude", result.get("longitude", 0))
-        
-        return result
-    except requests.RequestException as e:
-        if span:
-            from opentelemetry.trace import Status, StatusCode
-            span.record_exception(e)
-            span.set_status(Status(StatusCode.ERROR, str(e)))
-        return None
-    finally:
-        if span:
-            span.end()
+            return result
+        except (httpx.HTTPError, ValueError) as e:
+            # ValueError covers orjson.JSONDecodeError on a malformed upstream body
+            if span:
+                from opentelemetry.trace import Status, StatusCode
+                span.record_exception(e)
+                span.set_status(Status(StatusCode.ERROR, str(e)))
+            return None
 
-def _get_weather_for_coords(lat: float, lon: float) -> Optional[Dict[str, Any]]:
+async def _get_weather_for_coords(lat: float, lon: float) -> Optional[Dict[str, Any]]:
     """
     Get current weather from Open-Meteo for given latitude & longitude.
     """
-    tracer = get_tracer(__name__)
-    span = None
-    if tracer:
-        span = tracer.start_span("get_weather_for_coords")
-        span.set_attribute("latitude", lat)
-        span.set_attribute("longitude", lon)
-    
-    try:
-        resp = requests.get(
-            WEATHER_URL,
-            params={
-                "latitude": lat,
-                "longitude": lon,
-                "current_weather": "true",
-                "timezone": "auto",  # Open-Meteo resolves local timezone
-            },
-            timeout=5,
-        )
-        resp.raise_for_status()
-        data = resp.json()
-        
-        current = data.get("current_weather")
-        if not current:
+    with traced_span(get_tracer(__name__), "get_weather_for_coords", {"latitude": lat, "longitude": lon}) as span:
+        try:
+            result = await _fetch_weather(lat, lon)
+            if not result:
+                if span:
+                    span.set_attribute("weather_available", False)
+                return None
+
             if span:
-                span.set_attribute("weather_available", False)
+                span.set_attributes({
+                    "weather_available": True,
+                    "temperature_c": result.get("temperature_c", 0),
+                    "windspeed_kmh": result.get("windspeed_kmh", 0),
+                })
+
+            return result
+        except (httpx.HTTPError, ValueError) as e:
+            if span:
+                from opentelemetry.trace import Status, StatusCode
+                span.record_exception(e)
+                span.set_status(Status(StatusCode.ERROR, str(e)))
             return None
 
-        result = {
-            "temperature_c": current.get("temperature"),
-            "windspeed_kmh": current.get("windspeed"),
-            "weather_code": current.get("weathercode"),
-            "raw": current,
-        }
-        
-        if span:
-            span.set_attribute("weather_available", True)
-            span.set_attribute("temperature_c", result.get("temperature_c", 0))
-            span.set_attribute("windspeed_kmh", result.get("windspeed_kmh", 0))
-        
-        return result
-    except requests.RequestException as e:
-        if span:
-            from opentelemetry.trace import Status, StatusCode
-            span.record_exception(e)
-            span.set_status(Status(StatusCode.ERROR, str(e)))
-        return None
-    finally:
-        if span:
-            span.end()
-def get_city_weather_and_time(city: str) -> Dict[str, Any]:
+@functools.lru_cache(maxsize=512)
+def _tz(name: str) -> ZoneInfo:
+    """Return a cached ZoneInfo for name (avoids re-resolving tzdata per call)."""
+    return ZoneInfo(name)
+
+async def get_city_weather_and_time(city: str) -> Dict[str, Any]:
     """
     - takes a city name
     - finds lat/lon and timezone
@@ -135,96 +244,95 @@ def get_city_weather_and_time(city: str) -> Dict[str, Any]:
         "report": "In New York, United States it is 25.3 °C ...",
     }
     """
-    tracer = get_tracer(__name__)
-    span = None
-    if tracer:
-        span = tracer.start_span("get_city_weather_and_time")
-        span.set_attribute("city", city)
-    
-    try:
-        location = _geocode_city(city)
-        if not location:
-            result = {
-                "status": "error",
-                "error_message": f"Could not find location for '{city}'.",
-            }
-            if span:
-                span.set_attribute("status", "error")
-                span.set_attribute("error", result["error_message"])
-            return result
+    with traced_span(get_tracer(__name__), "get_city_weather_and_time", {"city": city}) as span:
+        try:
+            # Repeat cities are answered by the city table or the geocode cache
+            location = await _geocode_city(city)
+            if not location:
+                result = {
+                    "status": "error",
+                    "error_message": f"Could not find location for '{city}'.",
+                }
+                if span:
+                    span.set_attributes({
+                        "status": "error",
+                        "error": result["error_message"],
+                    })
+                return result
+
+            lat = location["latitude"]
+            lon = location["longitude"]
+            tz_name = location.get("timezone")
+            city_name = location.get("name", city)
+            country = location.get("country")
+
+            weather = await _get_weather_for_coords(lat, lon)
+            if not weather:
+                result = {
+                    "status": "error",
+                    "error_message": f"Weather not available for '{city_name}'.",
+                }
+                if span:
+                    span.set_attributes({
+                        "status": "error",
+                        "error": result["error_message"],
+                    })
+                return result
+
+            # Fallback: if geocoding didn't give timezone, use the one the
+            # forecast API resolved via timezone=auto.
+            if not tz_name:
+                tz_name = weather.get("timezone") or "UTC"
 
-        lat = location["latitude"]
-        lon = location["longitude"]
-        tz_name = location.get("timezone")
-        city_name = location.get("name", city)
-        country = location.get("country")
+            try:
+                tz = _tz(tz_name)
+                now = datetime.datetime.now(tz)
+            except Exception:
+                now = datetime.datetime.utcnow()
+                tz_name = "UTC"
+
+            place_label = f"{city_name}, {country}" if country else city_name
+
+            report = (
+                f"In {place_label} it is {weather['temperature_c']} °C "
+                f"with wind speed {weather['windspeed_kmh']} km/h. "
+                f"Local time is {now:%Y-%m-%d %H:%M:%S %Z}."
+            )
 
-        weather = _get_weather_for_coords(lat, lon)
-        if not weather:
             result = {
-                "status": "error",
-                "error_message": f"Weather not available for '{city_name}'.",
+                "status": "success",
+                "city": city_name,
+                "country": country,
+                "latitude": lat,
+                "longitude": lon,
+                "timezone": tz_name,
+                "temperature_c": weather["temperature_c"],
+                "windspeed_kmh": weather["windspeed_kmh"],
+                "local_time_iso": now.isoformat(),
+                "report": report,
+                "raw": {
+                    "location": location,
+                    "weather": weather["raw"],
+                },
             }
-            if span:
-                span.set_attribute("status", "error")
-                span.set_attribute("error", result["error_message"])
-            return result
 
-        # Fallback: if geocoding didn't give timezone, you could also use
-        # the `timezone` field from the weather API response (if present).
-        if not tz_name:
-            tz_name = "UTC"
+            if span:
+                span.set_attributes({
+                    "status": "success",
+                    "result_city": city_name,
+                    "temperature_c": weather["temperature_c"],
+                })
 
-        try:
-            tz = ZoneInfo(tz_name)
-            now = datetime.datetime.now(tz)
-        except Exception:
-            now = datetime.datetime.utcnow()
-            tz_name = "UTC"
-
-        place_label = f"{city_name}, {country}" if country else city_name
-
-        report = (
-            f"In {place_label} it is {weather['temperature_c']} °C "
-            f"with wind speed {weather['windspeed_kmh']} km/h. "
-            f"Local time is {now:%Y-%m-%d %H:%M:%S %Z}."
-        )
-
-        result = {
-            "status": "success",
-            "city": city_name,
-            "country": country,
-            "latitude": lat,
-            "longitude": lon,
-            "timezone": tz_name,
-            "temperature_c": weather["temperature_c"],
-            "windspeed_kmh": weather["windspeed_kmh"],
-            "local_time_iso": now.isoformat(),
-            "report": report,
-            "raw": {
-                "location": location,
-                "weather": weather["raw"],
-            },
-        }
-        
-        if span:
-            span.set_attribute("status", "success")
-            span.set_attribute("result_city", city_name)
-            span.set_attribute("temperature_c", weather["temperature_c"])
-        
-        return result
-    except Exception as e:
-        if span:
-            from opentelemetry.trace import Status, StatusCode
-            span.record_exception(e)
-            span.set_status(Status(StatusCode.ERROR, str(e)))
-        return {
-            "status": "error",
-            "error_message": f"Unexpected error: {str(e)}",
-        }
-    finally:
-        if span:
-            span.end()
+            return result
+        except Exception as e:
+            if span:
+                from opentelemetry.trace import Status, StatusCode
+                span.record_exception(e)
+                span.set_status(Status(StatusCode.ERROR, str(e)))
+            return {
+                "status": "error",
+                "error_message": f"Unexpected error: {str(e)}",
+            }
 
 root_agent = Agent(
     name="weather_time_agent",
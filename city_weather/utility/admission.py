@@ -0,0 +1,63 @@
+"""
+Admission control for concurrent agent runs.
+Requests beyond the limit wait for a free slot instead of piling onto
+Gemini, Firestore and the worker's memory all at once.
+"""
+import asyncio
+import contextlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Admission:
+    """
+    Condition-guarded counter capping the number of concurrent agent runs.
+    A Condition is used instead of a Semaphore so the limit can be resized
+    safely at runtime (see resize()).
+    """
+    def __init__(self, max_concurrency: int):
+        self._cond = asyncio.Condition()
+        self._active = 0
+        self._max_concurrency = max(1, int(max_concurrency))
+
+    @property
+    def active(self) -> int:
+        """Number of runs currently holding a slot."""
+        return self._active
+
+    @property
+    def max_concurrency(self) -> int:
+        """Current concurrency limit."""
+        return self._max_concurrency
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Wait until a slot is free, hold it for the body, then release it."""
+        async with self._cond:
+            try:
+                await self._cond.wait_for(lambda: self._active < self._max_concurrency)
+            except asyncio.CancelledError:
+                # We may have consumed a release's notify(1); pass it on so
+                # the next waiter isn't left hanging with a free slot
+                self._cond.notify(1)
+                raise
+            self._active += 1
+        try:
+            yield
+        finally:
+            # Shielded so a cancelled caller can't lose the slot or its wakeup
+            await asyncio.shield(self._release())
+
+    async def _release(self) -> None:
+        """Free a slot and wake one waiter under a single lock acquisition."""
+        async with self._cond:
+            self._active -= 1
+            self._cond.notify(1)
+
+    async def resize(self, max_concurrency: int) -> None:
+        """Change the concurrency limit, waking waiters if it grew."""
+        async with self._cond:
+            self._max_concurrency = max(1, int(max_concurrency))
+            self._cond.notify_all()
+        logger.info("Admission limit set to %s", self._max_concurrency)
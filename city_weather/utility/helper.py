@@ -1,9 +1,21 @@
+import asyncio
+import gzip
+import hashlib
 import os
-import json
-from typing import List, Optional
+import time
+import uuid
+from collections import OrderedDict, deque
+from itertools import islice
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
 
+import msgspec
+import orjson
 from google.cloud import firestore
 
+if TYPE_CHECKING:
+    from google.adk.sessions import Session
+    from google.genai.types import Content
+
 # Config from environment
 DB_COLLECTION = os.getenv("DB_COLLECTION", "Weather-Chat")
 FIRESTORE_DATABASE = os.getenv("FIRESTORE_DATABASE", "travel-concierge")
@@ -25,14 +37,97 @@ except Exception:
     Runner = None
     root_agent = None
 
+class MessagePart(msgspec.Struct, omit_defaults=True):
+    """One part of a chat message: text, function_call, function_response or unknown.
+    type is required so it is always serialized; unset optional fields are omitted.
+    """
+    type: str
+    text: Optional[str] = None
+    name: Optional[str] = None
+    id: Optional[str] = None
+    args: Any = None
+    response: Any = None
+    repr: Optional[str] = None
+
+
+class Message(msgspec.Struct):
+    """A chat message as handled in-process; stored in Firestore as a plain dict.
+    All fields are always serialized (text may be null), as consumers expect.
+    Stored "id"/"ts" are added to the dict at write time (see _stamp_messages).
+    """
+    sender: str = ""
+    text: Optional[str] = None
+    parts: List[MessagePart] = []
+
+
+def _as_message(m) -> Optional[Message]:
+    """Return m as a Message (converting a stored dict), or None if it is malformed."""
+    if isinstance(m, Message):
+        return m
+    try:
+        return msgspec.convert(m, Message)
+    except msgspec.ValidationError:
+        logging.warning("Skipping malformed stored message: %r", m)
+        return None
+
+
+def _message_dicts(messages: List[Any]) -> List[dict]:
+    """Convert Message structs to Firestore-ready dicts (dicts pass through)."""
+    return [msgspec.to_builtins(m, enc_hook=str) if isinstance(m, msgspec.Struct) else m for m in messages]
+
+
+# Shared Runner, built once by get_runner()
+_runner = None
+
+# (Content, Part) from google.genai.types, resolved once by _get_content_types()
+_content_types = None
+
 # History limits (can be overridden via env)
 MAX_HISTORY_MESSAGES = int(os.getenv("MAX_HISTORY_MESSAGES", "20"))
 MAX_HISTORY_CHARS = int(os.getenv("MAX_HISTORY_CHARS", "8000"))
 
+# Shared Firestore client, created lazily by get_db()
+_db: Optional[firestore.AsyncClient] = None
+
+# In-process LRU+TTL cache of conversations, keyed by
+# (bot_collection, user_id, sanitized session_id) (see load_conversation)
+CONVERSATION_CACHE_TTL = float(os.getenv("CONVERSATION_CACHE_TTL", "10"))
+CONVERSATION_CACHE_SIZE = int(os.getenv("CONVERSATION_CACHE_SIZE", "1024"))
+_conv_cache: "OrderedDict[Tuple[str, str, str], Tuple[float, List[dict]]]" = OrderedDict()
+_conv_inflight: Dict[Tuple[str, str, str], "asyncio.Future[List[dict]]"] = {}
+# Queued-but-unflushed write counts per conversation; reads of these aren't cached
+_pending_writes: Dict[Tuple[str, str, str], int] = {}
+
+# Buffered conversation writes (see enqueue_conversation)
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "50"))
+WRITE_BATCH_WINDOW_MS = int(os.getenv("WRITE_BATCH_WINDOW_MS", "50"))
+WRITE_DRAIN_TIMEOUT_S = float(os.getenv("WRITE_DRAIN_TIMEOUT_S", "10"))
+# Store each message's parts as a gzip-compressed JSON Bytes field ("parts_blob").
+# Messages are read back either way, so this can be flipped during rollout.
+COMPRESS_MESSAGE_PARTS = os.getenv("COMPRESS_MESSAGE_PARTS", "false").lower() == "true"
+
+# Firestore rejects batches with more than 500 writes
+MAX_BATCH_WRITES = 500
+
+# Concurrent conversation writes in save_conversations_bulk; throughput plateaus around here
+BULK_WRITE_CONCURRENCY = 40
+_write_queue: Optional[asyncio.Queue] = None
+_writer_task: Optional[asyncio.Task] = None
+
 
 def get_db():
-    """Return an AsyncClient for Firestore."""
-    return firestore.AsyncClient(database=FIRESTORE_DATABASE)
+    """Return the shared AsyncClient for Firestore, creating it on first use.
+    Reusing one client keeps its gRPC channel (and credentials) warm across requests.
+    """
+    global _db
+    if _db is None:
+        _db = firestore.AsyncClient(database=FIRESTORE_DATABASE)
+    return _db
+
+
+# Characters not allowed in Firestore collection/document ids, mapped to "_".
+# Only "/" is forbidden; other characters stay as-is so existing paths don't move.
+_SESSION_ID_TRANS = str.maketrans({"/": "_"})
 
 
 def sanitize_session_id(session_id: str) -> str:
@@ -41,76 +136,397 @@ def sanitize_session_id(session_id: str) -> str:
     """
     if session_id is None:
         return "default"
-    return str(session_id).replace("/", "_")
+    return str(session_id).translate(_SESSION_ID_TRANS)
+
+
+def _cache_get(key: Tuple[str, str, str]) -> Optional[List[dict]]:
+    """Return cached messages for key, or None if absent or expired."""
+    entry = _conv_cache.get(key)
+    if entry is None:
+        return None
+    cached_at, messages = entry
+    if time.monotonic() - cached_at > CONVERSATION_CACHE_TTL:
+        del _conv_cache[key]
+        return None
+    _conv_cache.move_to_end(key)
+    return messages
+
+
+def _cache_put(key: Tuple[str, str, str], messages: List[dict]) -> None:
+    """Store messages for key, evicting least recently used entries over the size bound."""
+    _conv_cache[key] = (time.monotonic(), messages)
+    _conv_cache.move_to_end(key)
+    while len(_conv_cache) > CONVERSATION_CACHE_SIZE:
+        _conv_cache.popitem(last=False)
+
 
+def _cache_append(key: Tuple[str, str, str], messages: List[dict], max_conversation_messages: Optional[int] = None, new_conversation: bool = False) -> None:
+    """Extend a cached conversation with newly written messages (no-op if not
+    cached). With new_conversation, messages are the whole history and seed the cache.
+    """
+    if new_conversation:
+        cached = []
+    else:
+        cached = _cache_get(key)
+        if cached is None:
+            return
+    keep = MAX_HISTORY_MESSAGES
+    if max_conversation_messages:
+        keep = min(keep, int(max_conversation_messages))
+    _cache_put(key, (cached + messages)[-keep:])
+
+
+def _write_done(key: Tuple[str, str, str]) -> None:
+    """Mark one queued write for key as flushed (or failed)."""
+    remaining = _pending_writes.get(key, 0) - 1
+    if remaining > 0:
+        _pending_writes[key] = remaining
+    else:
+        _pending_writes.pop(key, None)
+
+
+def _conversation_ref(db: firestore.AsyncClient, bot_collection: str, user_id: str, session_id: str):
+    """Summary document of a conversation; its messages live in the "messages" subcollection."""
+    return db.collection(bot_collection).document(user_id).collection(session_id).document("conversation")
 
-async def load_conversation(user_id: str, session_id: str, bot_collection: Optional[str] = None, db: Optional[firestore.AsyncClient] = None) -> List[dict]:
-    """Load messages list from /{bot_collection}/{user_id}/{session_id}/conversation.
-    Returns [] when not found or on error.
+
+async def _stream_messages(query) -> List[dict]:
+    """Run a newest-first messages query and return the messages oldest first."""
+    messages = [_decode_message(doc.to_dict()) async for doc in query.stream()]
+    messages.reverse()
+    return messages
+
+
+async def load_conversation(user_id: str, session_id: str, *, bot_collection: Optional[str] = None, db: Optional[firestore.AsyncClient] = None) -> List[dict]:
+    """Load the latest MAX_HISTORY_MESSAGES messages (oldest first) from
+    /{bot_collection}/{user_id}/{session_id}/conversation/messages.
+    Pre-subcollection history (the summary document's "messages" array) fills
+    any remaining slots, oldest first.
+    Served from the in-process cache when fresh; concurrent misses for the same
+    conversation share one Firestore read. Returns [] when not found or on error.
+    The returned list is shared with the cache and must not be mutated.
+    bot_collection and db are keyword-only so a collection can't be passed as user_id.
     """
     bot_collection = bot_collection or DB_COLLECTION
-    db = db or get_db()
     session_id = sanitize_session_id(session_id)
-    conv_doc = db.collection(bot_collection).document(user_id).collection(session_id).document("conversation")
+    key = (bot_collection, user_id, session_id)
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached
+
+    # Single-flight: concurrent misses await one shared fetch task. It is
+    # shielded so a cancelled caller doesn't cancel the others' read.
+    task = _conv_inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_fetch_conversation(key, db or get_db()))
+        _conv_inflight[key] = task
+        task.add_done_callback(lambda t: _conv_inflight.pop(key, None) if _conv_inflight.get(key) is t else None)
+    return await asyncio.shield(task)
+
+
+async def _fetch_conversation(key: Tuple[str, str, str], db: firestore.AsyncClient) -> List[dict]:
+    """Read a conversation's latest messages from Firestore and cache them
+    (see load_conversation). Returns [] on error without caching.
+    """
+    bot_collection, user_id, session_id = key
+    conv_doc = _conversation_ref(db, bot_collection, user_id, session_id)
+    query = (
+        conv_doc.collection("messages")
+        .order_by("ts", direction=firestore.Query.DESCENDING)
+        .limit(MAX_HISTORY_MESSAGES)
+    )
     try:
-        snap = await conv_doc.get()
-        if snap and snap.exists:
-            data = snap.to_dict() or {}
-            return data.get("messages", []) or []
+        # Conversations written before the messages subcollection keep
+        # older history in the summary document; fetch just that field
+        # alongside the query so a miss is still one round trip
+        messages, snap = await asyncio.gather(
+            _stream_messages(query),
+            conv_doc.get(field_paths=["messages"]),
+        )
+        if len(messages) < MAX_HISTORY_MESSAGES and snap and snap.exists:
+            legacy = (snap.to_dict() or {}).get("messages", []) or []
+            if legacy:
+                messages = legacy[-(MAX_HISTORY_MESSAGES - len(messages)):] + messages
     except Exception:
         # swallow and return empty — caller handles missing history
         return []
-    return []
+    # A queued turn may not be in what we just read; don't pin it in the cache
+    if key not in _pending_writes:
+        _cache_put(key, messages)
+    return messages
+
+
+def _stamp_messages(messages: List[dict]) -> List[dict]:
+    """Give each message a monotonic "ts" and a unique, ts-ordered "id" (its document id).
+    Messages that already carry them (e.g. in a backfill) keep theirs, so their
+    original order is preserved and re-saving overwrites instead of duplicating.
+    """
+    base = time.time_ns()
+    stamped = []
+    for i, m in enumerate(messages):
+        if m.get("ts") is not None and m.get("id"):
+            stamped.append(m)
+            continue
+        ts = m.get("ts")
+        if ts is None:
+            ts = base + i
+            suffix = uuid.uuid4().hex[:8]
+        else:
+            # Caller-supplied ts: derive the suffix from the content so re-saves match
+            suffix = hashlib.blake2b(orjson.dumps(m, default=str, option=orjson.OPT_SORT_KEYS), digest_size=4).hexdigest()
+        stamped.append({**m, "ts": ts, "id": m.get("id") or f"{ts:020d}-{suffix}"})
+    return stamped
+
+
+def _encode_message(message: dict) -> dict:
+    """Firestore body for a message, compressing its parts if COMPRESS_MESSAGE_PARTS is set."""
+    if not COMPRESS_MESSAGE_PARTS or not message.get("parts"):
+        return message
+    encoded = dict(message)
+    encoded["parts_blob"] = gzip.compress(orjson.dumps(encoded.pop("parts"), default=str), compresslevel=1)
+    return encoded
+
+
+def _decode_message(data: dict) -> dict:
+    """Inverse of _encode_message; plain messages pass through unchanged."""
+    blob = data.pop("parts_blob", None)
+    if blob is not None:
+        data["parts"] = orjson.loads(gzip.decompress(blob))
+    return data
+
+
+def _summary_payload(user_id: str, session_id: str, messages: List[dict]) -> dict:
+    """Merge-set body for the summary document after appending messages."""
+    last_msg = messages[-1] if messages else {"text": "", "sender": ""}
+    return {
+        "user_id": user_id,
+        "session_id": session_id,
+        "last_message_text": last_msg.get("text", ""),
+        "last_message_sender": last_msg.get("sender", ""),
+        "last_message_at": firestore.SERVER_TIMESTAMP,
+        "message_count": firestore.Increment(len(messages)),
+        "timestamp": firestore.SERVER_TIMESTAMP,
+    }
+
+
+def _append_writes(db: firestore.AsyncClient, key: Tuple[str, str, str], messages: List[dict]) -> List[tuple]:
+    """(reference, data) pairs appending messages to a conversation: one document
+    per message plus the summary merge. No reads are needed.
+    """
+    bot_collection, user_id, session_id = key
+    conv_doc = _conversation_ref(db, bot_collection, user_id, session_id)
+    messages_col = conv_doc.collection("messages")
+    writes = [(messages_col.document(m["id"]), _encode_message(m)) for m in messages]
+    writes.append((conv_doc, _summary_payload(user_id, session_id, messages)))
+    return writes
 
 
-async def save_conversation(user_id: str, session_id: str, messages: List[dict], bot_collection: Optional[str] = None, db: Optional[firestore.AsyncClient] = None, max_conversation_messages: Optional[int] = None) -> None:
-    """Append messages to the single conversation document at /{bot_collection}/{user_id}/{session_id}/conversation.
-    Optionally trims to the last max_conversation_messages.
+async def _commit_writes(db: firestore.AsyncClient, writes: List[tuple]) -> None:
+    """Commit (reference, data) pairs in as few batches as Firestore's per-batch limit allows.
+    A lone write skips the batch wrapper and goes out as a plain set().
+    """
+    if len(writes) == 1:
+        ref, data = writes[0]
+        await ref.set(data, merge=True)
+        return
+    for start in range(0, len(writes), MAX_BATCH_WRITES):
+        batch = db.batch()
+        for ref, data in writes[start:start + MAX_BATCH_WRITES]:
+            batch.set(ref, data, merge=True)
+        await batch.commit()
+
+
+async def _trim_conversation(db: firestore.AsyncClient, key: Tuple[str, str, str], max_conversation_messages: int) -> None:
+    """Delete all but the newest max_conversation_messages messages of a conversation."""
+    bot_collection, user_id, session_id = key
+    conv_doc = _conversation_ref(db, bot_collection, user_id, session_id)
+    query = (
+        conv_doc.collection("messages")
+        .order_by("ts", direction=firestore.Query.DESCENDING)
+        .offset(int(max_conversation_messages))
+    )
+    stale = [doc.reference async for doc in query.stream()]
+    for start in range(0, len(stale), MAX_BATCH_WRITES - 1):
+        chunk = stale[start:start + MAX_BATCH_WRITES - 1]
+        batch = db.batch()
+        for ref in chunk:
+            batch.delete(ref)
+        batch.set(conv_doc, {"message_count": firestore.Increment(-len(chunk))}, merge=True)
+        await batch.commit()
+
+
+async def save_conversation(user_id: str, session_id: str, messages: List[Any], bot_collection: Optional[str] = None, db: Optional[firestore.AsyncClient] = None, max_conversation_messages: Optional[int] = None) -> None:
+    """Append messages to /{bot_collection}/{user_id}/{session_id}/conversation/messages,
+    one document each, and update the summary document in the same batch.
+    With max_conversation_messages, older messages are deleted afterwards.
     """
     bot_collection = bot_collection or DB_COLLECTION
     db = db or get_db()
-    session_id = sanitize_session_id(session_id)
-    conv_doc = db.collection(bot_collection).document(user_id).collection(session_id).document("conversation")
+    key = (bot_collection, user_id, sanitize_session_id(session_id))
+    messages = _stamp_messages(_message_dicts(messages))
 
     try:
-        existing_snap = await conv_doc.get()
-        existing = existing_snap.to_dict() or {}
-        existing_msgs = existing.get("messages", [])
+        await _commit_writes(db, _append_writes(db, key, messages))
+        _cache_append(key, messages, max_conversation_messages)
+        if max_conversation_messages:
+            await _trim_conversation(db, key, max_conversation_messages)
     except Exception:
-        existing_msgs = []
+        _conv_cache.pop(key, None)
+        logging.exception("Failed to save conversation to Firestore")
 
-    new_messages = existing_msgs + messages
-    if max_conversation_messages:
-        new_messages = new_messages[-int(max_conversation_messages):]
-
-    batch = db.batch()
-    last_msg = new_messages[-1] if new_messages else {"text": "", "sender": ""}
-    batch.set(
-        conv_doc,
-        {
-            "user_id": user_id,
-            "session_id": session_id,
-            "messages": new_messages,
-            "last_message_text": last_msg.get("text", ""),
-            "last_message_sender": last_msg.get("sender", ""),
-            "last_message_at": firestore.SERVER_TIMESTAMP,
-            "message_count": len(new_messages),
-            "timestamp": firestore.SERVER_TIMESTAMP,
-        },
-        merge=True,
-    )
+
+async def save_conversations_bulk(conversations: List[Tuple[str, str, List[Any]]], bot_collection: Optional[str] = None, db: Optional[firestore.AsyncClient] = None, max_concurrency: int = BULK_WRITE_CONCURRENCY) -> None:
+    """Save many (user_id, session_id, messages) conversations, e.g. for backfills.
+    Give messages their original "ts" (epoch ns) and a stable "id" to keep
+    their order and make re-runs idempotent.
+    Each is written by save_conversation (which splits at the per-batch write
+    limit); up to max_concurrency of them are in flight at once.
+    """
+    db = db or get_db()
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def _one(user_id: str, session_id: str, messages: List[Any]) -> None:
+        async with semaphore:
+            await save_conversation(user_id, session_id, messages, bot_collection=bot_collection, db=db)
+
+    await asyncio.gather(*(_one(*conversation) for conversation in conversations))
+
+
+async def _flush_conversations(items: List[tuple], db: Optional[firestore.AsyncClient] = None) -> None:
+    """Write queued (bot_collection, user_id, session_id, messages, max_conversation_messages)
+    items. Items for the same conversation are merged in queue order and all
+    appends go out in shared batch commits; trimming runs afterwards.
+    """
+    db = db or get_db()
+    grouped = {}
+    for bot_collection, user_id, session_id, messages, max_msgs in items:
+        key = (bot_collection, user_id, session_id)
+        if key in grouped:
+            grouped[key][0].extend(messages)
+            grouped[key][1] = max_msgs
+        else:
+            grouped[key] = [list(messages), max_msgs]
+
+    writes = []
+    for key, (messages, _) in grouped.items():
+        writes.extend(_append_writes(db, key, messages))
+
+    # The cache was already extended at enqueue time; drop entries whose write failed
     try:
-        await batch.commit()
+        await _commit_writes(db, writes)
     except Exception:
+        for key in grouped:
+            _conv_cache.pop(key, None)
         logging.exception("Failed to commit batch to Firestore")
+        return
+
+    trimmed = [(key, max_msgs) for key, (_, max_msgs) in grouped.items() if max_msgs]
+    if trimmed:
+        results = await asyncio.gather(
+            *(_trim_conversation(db, key, max_msgs) for key, max_msgs in trimmed),
+            return_exceptions=True,
+        )
+        for (key, _), result in zip(trimmed, results):
+            if isinstance(result, Exception):
+                logging.error("Failed to trim conversation in Firestore", exc_info=result)
+
+
+async def _conversation_writer(queue: asyncio.Queue) -> None:
+    """Drain the write queue, flushing every WRITE_BATCH_SIZE items or WRITE_BATCH_WINDOW_MS."""
+    loop = asyncio.get_running_loop()
+    window = WRITE_BATCH_WINDOW_MS / 1000
+    while True:
+        pending = [await queue.get()]
+        deadline = loop.time() + window
+        while len(pending) < WRITE_BATCH_SIZE:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                pending.append(await asyncio.wait_for(queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        try:
+            await _flush_conversations(pending)
+        except Exception:
+            logging.exception("Failed to flush conversation writes")
+        finally:
+            for item in pending:
+                _write_done(item[:3])
+                queue.task_done()
+
+
+def start_conversation_writer() -> None:
+    """Start the background conversation writer on the running loop (idempotent)."""
+    global _write_queue, _writer_task
+    if _writer_task is not None and not _writer_task.done():
+        return
+    _write_queue = asyncio.Queue()
+    _writer_task = asyncio.get_running_loop().create_task(_conversation_writer(_write_queue))
+
+
+async def stop_conversation_writer() -> None:
+    """Flush everything still queued (for up to WRITE_DRAIN_TIMEOUT_S), then stop the background writer."""
+    global _write_queue, _writer_task
+    if _writer_task is None:
+        return
+    if not _writer_task.done():
+        try:
+            async with asyncio.timeout(WRITE_DRAIN_TIMEOUT_S):
+                await _write_queue.join()
+        except TimeoutError:
+            logging.error(
+                "Conversation writer did not drain within %ss; dropping %d queued writes",
+                WRITE_DRAIN_TIMEOUT_S, sum(_pending_writes.values()),
+            )
+        _writer_task.cancel()
+        try:
+            await _writer_task
+        except asyncio.CancelledError:
+            pass
+    _write_queue = None
+    _writer_task = None
+    _pending_writes.clear()
+
+
+def enqueue_conversation(user_id: str, session_id: str, messages: List[Any], bot_collection: Optional[str] = None, max_conversation_messages: Optional[int] = None, new_conversation: bool = False) -> None:
+    """Queue messages for the background writer without waiting on Firestore.
+    Pass new_conversation for a session's first turn so its messages seed the cache.
+    Starts the writer if needed, so this must be called from a running event loop.
+    """
+    start_conversation_writer()
+    bot_collection = bot_collection or DB_COLLECTION
+    session_id = sanitize_session_id(session_id)
+    messages = _stamp_messages(_message_dicts(messages))
+    # Update the cache now so the next turn sees this one even before the flush
+    key = (bot_collection, user_id, session_id)
+    _cache_append(key, messages, max_conversation_messages, new_conversation)
+    _pending_writes[key] = _pending_writes.get(key, 0) + 1
+    _write_queue.put_nowait((bot_collection, user_id, session_id, messages, max_conversation_messages))
+
+
+def get_runner():
+    """Return the shared ADK Runner, building it on first use.
+    The Runner holds no per-session state, so one instance serves every request.
+    """
+    global _runner
+    if _runner is None:
+        if session_service is None or artifact_service is None or Runner is None or root_agent is None:
+            raise RuntimeError("ADK dependencies are not available in this environment")
+        _runner = Runner(agent=root_agent, app_name=APP_NAME, session_service=session_service, artifact_service=artifact_service)
+    return _runner
 
 
 async def create_runner(user_id: str, session_id: Optional[str]):
-    """Spin up an in‑memory ADK Session + Runner and return (session, runner).
-    This mirrors the previous implementation that lived in main.py.
+    """Resolve (or create) the in‑memory ADK Session and return (session, runner).
+    The runner is the shared instance from get_runner().
     """
-    if session_service is None or artifact_service is None or Runner is None or root_agent is None:
-        raise RuntimeError("ADK dependencies are not available in this environment")
+    runner = get_runner()
+    # Existing sessions are the common case: a lookup avoids a raised AlreadyExistsError
+    if session_id is not None:
+        session = await session_service.get_session(app_name=APP_NAME, user_id=user_id, session_id=session_id)
+        if session is not None:
+            return session, runner
     try:
         session = await session_service.create_session(app_name=APP_NAME, user_id=user_id, session_id=session_id)
     except Exception as e:
@@ -120,108 +536,151 @@ async def create_runner(user_id: str, session_id: Optional[str]):
                 raise
         else:
             raise
-    runner = Runner(agent=root_agent, app_name=APP_NAME, session_service=session_service, artifact_service=artifact_service)
     return session, runner
 
 
-async def build_content_with_history(user_id: str, session, query: str) -> 'Content':
-    """Load prior conversation and build a Content object with history prepended if available."""
-    try:
-        prior_messages = await load_conversation(DB_COLLECTION, user_id, session.id)
-    except Exception:
-        logging.exception("Failed to load prior messages")
-        prior_messages = []
-
-    if prior_messages:
-        prior_messages = prior_messages[-MAX_HISTORY_MESSAGES:]
-        history_lines = []
-        for m in prior_messages:
-            sender = m.get("sender", "")
-            text = m.get("text")
-            if text:
-                history_lines.append(f"{sender}: {text}")
-            else:
-                parts = m.get("parts", [])
-                part_texts = []
-                for p in parts:
-                    ptype = p.get("type")
-                    if ptype == "text":
-                        part_texts.append(p.get("text", ""))
-                    elif ptype == "function_call":
-                        part_texts.append(f"[function_call name={p.get('name')} args={p.get('args')}]")
-                    elif ptype == "function_response":
-                        part_texts.append(f"[function_response name={p.get('name')} response={p.get('response')}]")
-                    else:
-                        part_texts.append(str(p.get("repr", p)))
-                history_lines.append(f"{sender}: {' | '.join(part_texts)}")
-
-        history_text = "History:\n" + "\n".join(history_lines) + "\n\n"
-        if len(history_text) > MAX_HISTORY_CHARS and history_lines:
-            while history_lines and len("History:\n" + "\n".join(history_lines) + "\n\n") > MAX_HISTORY_CHARS:
-                history_lines.pop(0)
-            history_text = "History:\n" + "\n".join(history_lines) + "\n\n"
-        content_text = history_text + "User: " + query
-    else:
-        content_text = query
-    # Import Content/Part lazily to avoid circular/static import issues
-    try:
-        from google.genai.types import Content
-    except Exception:
-        Content = None
+class _PlaceholderContent:
+    """Stand-in with Content's attributes, used when google.genai is unavailable (e.g. runtime tests)."""
+    def __init__(self, role, parts):
+        self.role = role
+        self.parts = parts
+
+
+def _get_content_types():
+    """Return (Content, Part) from google.genai.types, or (None, None) if unavailable.
+    Imported lazily to avoid circular/static import issues, then cached.
+    """
+    global _content_types
+    if _content_types is None:
+        try:
+            from google.genai.types import Content, Part
+            _content_types = (Content, Part)
+        except Exception:
+            _content_types = (None, None)
+    return _content_types
+
+
+def _make_content(text: str) -> 'Content':
+    """Wrap text in a user Content with a single text Part."""
+    Content, Part = _get_content_types()
     if Content is None:
-        # create a simple placeholder object with expected attributes for runtime tests
-        class _C:
-            def __init__(self, role, parts):
-                self.role = role
-                self.parts = parts
-        return _C(role="user", parts=[{"text": content_text}])
-    return Content(role="user", parts=[__import__('google.genai.types', fromlist=['Part']).Part(text=content_text)])
+        return _PlaceholderContent(role="user", parts=[{"text": text}])
+    return Content(role="user", parts=[Part(text=text)])
+
+
+async def build_content_with_history(user_id: str, session: 'Session', query: str, prior_messages: Optional[List[dict]] = None) -> 'Content':
+    """Build a Content object with history prepended if available.
+    Pass prior_messages when the caller already loaded them (e.g. concurrently
+    with session creation); otherwise they are loaded here.
+    """
+    if prior_messages is None:
+        try:
+            prior_messages = await load_conversation(user_id=user_id, session_id=session.id, bot_collection=DB_COLLECTION)
+        except Exception:
+            logging.exception("Failed to load prior messages")
+            prior_messages = []
+
+    if not prior_messages:
+        # First turn (or no stored history): nothing to render
+        return _make_content(query)
+
+    # Render newest-first against the remaining char budget so "History:\n"
+    # + "\n".join(lines) + "\n\n" fits MAX_HISTORY_CHARS; older messages
+    # that can't fit are never rendered and the prompt is joined once.
+    budget = MAX_HISTORY_CHARS - (len("History:\n") + len("\n\n") - 1)
+    kept = deque()
+    for m in islice(reversed(prior_messages), MAX_HISTORY_MESSAGES):
+        m = _as_message(m)
+        if m is None:
+            continue
+        text = m.text
+        if text:
+            line = f"{m.sender}: {text}"
+        else:
+            part_texts = []
+            for p in m.parts:
+                ptype = p.type
+                if ptype == "text":
+                    part_texts.append(p.text or "")
+                elif ptype == "function_call":
+                    part_texts.append(f"[function_call name={p.name} args={p.args}]")
+                elif ptype == "function_response":
+                    part_texts.append(f"[function_response name={p.name} response={p.response}]")
+                else:
+                    part_texts.append(p.repr if p.repr is not None else msgspec.json.encode(p, enc_hook=str).decode())
+            line = f"{m.sender}: {' | '.join(part_texts)}"
+        budget -= len(line) + 1
+        if budget < 0:
+            break
+        kept.appendleft(line)
 
+    buf = ["History:\n"]
+    buf_append = buf.append
+    for line in kept:
+        buf_append(line)
+        buf_append("\n")
+    buf_append("\n" if kept else "\n\n")
+    buf_append("User: ")
+    buf_append(query)
+    return _make_content("".join(buf))
 
-def process_event_parts(event) -> Optional[dict]:
-    """Return a dict with sender, text, parts for a single event, or None."""
+
+def process_event_parts(event) -> Optional[Message]:
+    """Return a Message with sender, text, parts for a single event, or None."""
     if not (getattr(event, 'content', None) and getattr(event.content, 'parts', None)):
         return None
-    parts_list = []
+    parts = event.content.parts
+    # Every part yields exactly one MessagePart, so fill a presized list
+    parts_list = [None] * len(parts)
     text_parts = []
-    for part in event.content.parts:
-        if getattr(part, "text", None):
-            parts_list.append({"type": "text", "text": part.text})
-            text_parts.append(part.text)
-        elif getattr(part, "function_call", None):
+    text_parts_append = text_parts.append
+    for i, part in enumerate(parts):
+        # genai Parts always carry these fields (None when unset); getattr only
+        # for foreign part objects
+        try:
+            part_text = part.text
             fc = part.function_call
+            fr = part.function_response
+        except AttributeError:
+            part_text = getattr(part, "text", None)
+            fc = getattr(part, "function_call", None)
+            fr = getattr(part, "function_response", None)
+        if part_text:
+            parts_list[i] = MessagePart(type="text", text=part_text)
+            text_parts_append(part_text)
+        elif fc:
             try:
                 args_val = fc.args
             except Exception:
                 args_val = getattr(fc, "args", str(fc))
                 logging.exception("function_call.args access error")
-            parts_list.append({
-                "type": "function_call",
-                "name": getattr(fc, "name", None),
-                "id": getattr(fc, "id", None),
-                "args": args_val,
-            })
-        elif getattr(part, "function_response", None):
-            fr = part.function_response
+            parts_list[i] = MessagePart(
+                type="function_call",
+                name=fc.name,
+                id=fc.id,
+                args=args_val,
+            )
+        elif fr:
             try:
                 resp_val = fr.response
             except Exception:
                 resp_val = getattr(fr, "response", str(fr))
                 logging.exception("function_response.response access error")
-            parts_list.append({
-                "type": "function_response",
-                "name": getattr(fr, "name", None),
-                "id": getattr(fr, "id", None),
-                "response": resp_val,
-            })
+            parts_list[i] = MessagePart(
+                type="function_response",
+                name=fr.name,
+                id=fr.id,
+                response=resp_val,
+            )
         else:
             try:
-                part_repr = str(part)
+                dump = part.model_dump(exclude_none=True) if hasattr(part, "model_dump") else part
+                part_repr = orjson.dumps(dump, default=str).decode()
             except Exception:
                 part_repr = repr(part)
                 logging.exception("part repr error")
-            parts_list.append({"type": "unknown", "repr": part_repr})
+            parts_list[i] = MessagePart(type="unknown", repr=part_repr)
 
     concatenated_text = "\n".join(text_parts) if text_parts else None
     sender = getattr(event, "role", "agent") or "agent"
-    return {"sender": sender, "text": concatenated_text, "parts": parts_list}
+    return Message(sender=sender, text=concatenated_text, parts=parts_list)
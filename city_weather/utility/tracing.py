@@ -2,26 +2,53 @@
 Tracing configuration for Cloud Trace (GCP) and LangSmith.
 This module sets up OpenTelemetry instrumentation for both services.
 """
+import contextlib
 import os
 import logging
+import re
 from typing import Optional
 
 logger = logging.getLogger(__name__)
 
-# LangSmith configuration - reload from env each time to ensure latest values
-def get_langsmith_config():
-    """Get LangSmith configuration from environment variables."""
-    return {
+# LangSmith configuration, read from env once and cached;
+# call refresh_langsmith_config() after changing the environment
+_langsmith_config: Optional[dict] = None
+
+
+def refresh_langsmith_config() -> dict:
+    """Re-read LangSmith configuration from environment variables and cache it."""
+    global _langsmith_config
+    _langsmith_config = {
         "otel_enabled": os.getenv("LANGSMITH_OTEL_ENABLED", "false").lower() == "true",
         "tracing": os.getenv("LANGSMITH_TRACING", "false").lower() == "true",
         "project": os.getenv("LANGSMITH_PROJECT", os.getenv("LANGCHAIN_PROJECT", "default")),
         "api_key": os.getenv("LANGSMITH_API_KEY", os.getenv("LANGCHAIN_API_KEY", "")),
         "endpoint": os.getenv("LANGSMITH_ENDPOINT", "https://api.smith.langchain.com"),
     }
+    return _langsmith_config
+
+
+def get_langsmith_config() -> dict:
+    """Get the cached LangSmith configuration (read from env on first use)."""
+    if _langsmith_config is None:
+        return refresh_langsmith_config()
+    return _langsmith_config
+
 
 # GCP Cloud Trace configuration
 GCP_PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT") or os.getenv("GCP_PROJECT_ID")
 
+# Manual spans are only created once setup_tracing() attaches an exporter, or,
+# if it never runs, once a host such as `adk web` installs a real
+# TracerProvider; otherwise get_tracer() returns None and callers take their
+# untraced fast path.
+_tracing_enabled = False
+# True once setup_tracing() has decided; host-provider detection then stops
+_tracing_decided = False
+_tracers = {}
+# opentelemetry.trace once imported, False if OpenTelemetry isn't installed
+_otel_trace = None
+
 
 def setup_tracing():
     """
@@ -42,7 +69,7 @@ def setup_tracing():
         })
         
         # Prepare LangSmith configuration first
-        langsmith_config = get_langsmith_config()
+        langsmith_config = refresh_langsmith_config()
         langsmith_configured = False
         
         # Set environment variable to exclude HTTP spans from LangSmith
@@ -65,16 +92,18 @@ def setup_tracing():
             # But we'll ensure only agent spans go to LangSmith via filtering
         
         # Set up GCP Cloud Trace exporter
+        cloud_trace_configured = False
         if GCP_PROJECT_ID:
             try:
                 from opentelemetry.exporter.cloud_trace import CloudTraceSpanExporter
                 cloud_trace_exporter = CloudTraceSpanExporter(project_id=GCP_PROJECT_ID)
                 provider.add_span_processor(BatchSpanProcessor(cloud_trace_exporter))
-                logger.info(f"Cloud Trace exporter initialized for project: {GCP_PROJECT_ID}")
+                cloud_trace_configured = True
+                logger.info("Cloud Trace exporter initialized for project: %s", GCP_PROJECT_ID)
             except ImportError:
                 logger.warning("opentelemetry-exporter-gcp-trace not available. Cloud Trace will not be enabled.")
             except Exception as e:
-                logger.warning(f"Failed to initialize Cloud Trace exporter: {e}")
+                logger.warning("Failed to initialize Cloud Trace exporter: %s", e)
         else:
             logger.warning("GCP_PROJECT_ID not set. Cloud Trace will not be enabled.")
         
@@ -99,17 +128,18 @@ def setup_tracing():
                 os.environ["LANGSMITH_TRACING"] = "true"
                 os.environ["LANGSMITH_PROJECT"] = langsmith_config['project']
                 os.environ["LANGSMITH_API_KEY"] = langsmith_config['api_key']
+                refresh_langsmith_config()
                 
                 logger.warning("LangSmith OTEL exporter was not configured earlier; env vars set but no exporter attached.")
             except Exception as e:
-                logger.error(f"Failed to set up LangSmith tracing: {e}", exc_info=True)
+                logger.error("Failed to set up LangSmith tracing: %s", e, exc_info=True)
         else:
             missing = []
             if not langsmith_config['otel_enabled'] and not langsmith_config['tracing']:
                 missing.append("LANGSMITH_OTEL_ENABLED or LANGSMITH_TRACING")
             if not langsmith_config['api_key']:
                 missing.append("LANGSMITH_API_KEY")
-            logger.warning(f"LangSmith tracing not enabled. Missing: {', '.join(missing)}")
+            logger.warning("LangSmith tracing not enabled. Missing: %s", ', '.join(missing))
         
         # Instrument FastAPI
         try:
@@ -119,25 +149,67 @@ def setup_tracing():
         except ImportError:
             logger.warning("opentelemetry-instrumentation-fastapi not available.")
         
-        # Instrument requests library
+        # Instrument httpx library (agent tool calls to Open-Meteo)
         try:
-            from opentelemetry.instrumentation.requests import RequestsInstrumentor
-            RequestsInstrumentor().instrument()
-            logger.info("Requests library instrumented")
+            from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
+            HTTPXClientInstrumentor().instrument()
+            logger.info("HTTPX library instrumented")
         except ImportError:
-            logger.warning("opentelemetry-instrumentation-requests not available.")
+            logger.warning("opentelemetry-instrumentation-httpx not available.")
         
         logger.info("Tracing setup completed")
+        # Without an exporter every span would be dropped; keep the span-free path
+        exporting = cloud_trace_configured or langsmith_configured
+        if not exporting:
+            logger.warning("No span exporter configured; manual spans disabled")
+        _set_tracing_enabled(exporting, decided=True)
         return provider
         
     except ImportError as e:
-        logger.warning(f"OpenTelemetry not available: {e}. Tracing will be disabled.")
+        logger.warning("OpenTelemetry not available: %s. Tracing will be disabled.", e)
+        _set_tracing_enabled(False, decided=True)
         return None
     except Exception as e:
-        logger.error(f"Failed to set up tracing: {e}", exc_info=True)
+        logger.error("Failed to set up tracing: %s", e, exc_info=True)
+        _set_tracing_enabled(False, decided=True)
         return None
 
 
+def _set_tracing_enabled(enabled: bool, decided: bool = False) -> None:
+    """Flip the manual-span fast path and drop cached tracers.
+    decided=True records that setup_tracing() made the call, which then sticks.
+    """
+    global _tracing_enabled, _tracing_decided
+    _tracing_enabled = enabled
+    _tracing_decided = _tracing_decided or decided
+    _tracers.clear()
+
+
+def _provider_installed() -> bool:
+    """Return True if the global TracerProvider is a real one (not the proxy/no-op default)."""
+    global _otel_trace
+    if _otel_trace is None:
+        try:
+            from opentelemetry import trace
+            _otel_trace = trace
+        except ImportError:
+            _otel_trace = False
+    if not _otel_trace:
+        return False
+    provider = _otel_trace.get_tracer_provider()
+    return not isinstance(provider, (_otel_trace.ProxyTracerProvider, _otel_trace.NoOpTracerProvider))
+
+
+def tracing_enabled() -> bool:
+    """Return True if manual spans should be created.
+    After setup_tracing() this is whether it attached an exporter; without it
+    (e.g. under `adk web`) it turns on once a host installs a real provider.
+    """
+    if not _tracing_enabled and not _tracing_decided and _provider_installed():
+        _set_tracing_enabled(True)
+    return _tracing_enabled
+
+
 def get_tracer(name: Optional[str] = None):
     """
     Get a tracer instance for manual instrumentation.
@@ -146,36 +218,68 @@ def get_tracer(name: Optional[str] = None):
         name: Name of the tracer (defaults to module name)
     
     Returns:
-        Tracer instance or None if tracing is not available
+        Tracer instance or None if tracing is not available or no real tracer
+        provider is installed yet. Call sites skip span work entirely on None;
+        once a provider is seen this is a flag check plus a dict hit.
     """
-    try:
-        from opentelemetry import trace
-        tracer_provider = trace.get_tracer_provider()
-        if tracer_provider is None:
-            return None
-        return trace.get_tracer(name or __name__)
-    except Exception:
+    if not tracing_enabled():
         return None
+    name = name or __name__
+    tracer = _tracers.get(name)
+    if tracer is None:
+        try:
+            from opentelemetry import trace
+            tracer = trace.get_tracer(name)
+        except Exception:
+            return None
+        _tracers[name] = tracer
+    return tracer
+
+
+def traced_span(tracer, name: str, attributes: Optional[dict] = None):
+    """
+    Context manager for a current span with all attributes set at creation.
+    
+    Args:
+        tracer: Tracer from get_tracer(), or None when tracing is unavailable
+        name: Span name
+        attributes: Initial span attributes
+    
+    Yields:
+        The span, or None when tracer is None
+    """
+    if tracer is None:
+        return contextlib.nullcontext()
+    return tracer.start_as_current_span(name, attributes=attributes)
 
 
 class FilteringSpanProcessor:
     """
     Span processor that filters out HTTP/FastAPI spans before sending to LangSmith.
-    Only sends agent/LLM traces with session_id/thread_id.
+    Only sends agent/LLM traces with session_id/thread_id. Accepted spans go
+    through a BatchSpanProcessor, which queues them and exports in batches.
     """
-    def __init__(self, exporter):
+    def __init__(self, exporter, **batch_options):
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
         self._exporter = exporter
-        self._excluded_names = {"POST", "GET", "PUT", "DELETE", "PATCH", "OPTIONS", "HEAD"}
+        self._batch = BatchSpanProcessor(exporter, **batch_options)
+        # Rules are precompiled once; _should_export runs on every span end
+        self._excluded_names = frozenset({"POST", "GET", "PUT", "DELETE", "PATCH", "OPTIONS", "HEAD"})
         self._excluded_prefixes = ("HTTP ", "/chat", "fastapi", "GET /", "POST /")
+        self._session_keys = frozenset({
+            "session_id", "thread_id", "conversation_id",
+            "langsmith.session_id", "langsmith.thread_id",
+        })
+        self._keyword_re = re.compile(r"invocation|run_query|agent|llm|gemini")
     
     def on_start(self, span, parent_context=None):
         """Called when a span starts."""
         pass
     
     def on_end(self, span):
-        """Called when a span ends - filter before exporting."""
+        """Called when a span ends - filter before queueing for export."""
         if self._should_export(span):
-            self._exporter.export([span])
+            self._batch.on_end(span)
     
     def _should_export(self, span) -> bool:
         """Return True if span should be sent to LangSmith."""
@@ -186,7 +290,7 @@ class FilteringSpanProcessor:
             return False
         
         # Exclude spans with HTTP-related prefixes
-        if any(span_name.startswith(prefix) for prefix in self._excluded_prefixes):
+        if span_name.startswith(self._excluded_prefixes):
             return False
         
         # Only include spans that have session_id/thread_id (agent traces)
@@ -194,28 +298,23 @@ class FilteringSpanProcessor:
         attrs = getattr(span, 'attributes', {}) or {}
         
         # Include if it has session_id, thread_id (agent traces)
-        if any(key in attrs for key in ['session_id', 'thread_id', 'conversation_id', 
-                                        'langsmith.session_id', 'langsmith.thread_id']):
+        if attrs.keys() & self._session_keys:
             return True
         
         # Include if it's an LLM invocation or agent run
-        span_name_lower = span_name.lower()
-        if any(keyword in span_name_lower for keyword in ['invocation', 'run_query', 'agent', 'llm', 'gemini']):
+        if self._keyword_re.search(span_name.lower()):
             return True
         
         # Default: exclude HTTP/infrastructure spans
         return False
     
     def shutdown(self):
-        """Shutdown the exporter."""
-        if hasattr(self._exporter, 'shutdown'):
-            self._exporter.shutdown()
+        """Export queued spans, then shut down the exporter."""
+        self._batch.shutdown()
     
     def force_flush(self, timeout_millis=30000):
-        """Force flush the exporter."""
-        if hasattr(self._exporter, 'force_flush'):
-            return self._exporter.force_flush(timeout_millis)
-        return True
+        """Export all queued spans."""
+        return self._batch.force_flush(timeout_millis)
 
 
 def _configure_langsmith_otel(langsmith_config: dict) -> bool: